@@ -3,33 +3,60 @@
 routine which renumbers all endnotes in content order
 """
 import argparse
+import copy
 import os
-from bs4 import BeautifulSoup, Tag
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from operator import attrgetter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from lxml import etree
 from se.formatting import format_xhtml
 
+# namespace prefixes for the element and attribute names we look for in the lxml trees
+XHTML_NS = "{http://www.w3.org/1999/xhtml}"
+OPF_NS = "{http://www.idpf.org/2007/opf}"
+EPUB_TYPE = "{http://www.idpf.org/2007/ops}type"
+
+# compiled once: the links we care about, searched for from (and including) whichever element is passed in
+NAMESPACES = {"xhtml": "http://www.w3.org/1999/xhtml", "epub": "http://www.idpf.org/2007/ops"}
+NOTEREF_XPATH = etree.XPath("descendant-or-self::xhtml:a[@epub:type='noteref']", namespaces=NAMESPACES)
+REFERRER_XPATH = etree.XPath("descendant-or-self::xhtml:a[contains(@epub:type, 'se:referrer') or contains(@epub:type, 'backlink')]", namespaces=NAMESPACES)
+# the opening tags of the same noterefs, and their hrefs, found in plain text before anything is parsed
+NOTEREF_REGEX = re.compile(r"""<a\b[^>]*\sepub:type\s*=\s*["']noteref["'][^>]*>""")
+HREF_REGEX = re.compile(r"""\shref\s*=\s*["']([^"']*)["']""")
+# every mention of noteref as a word (so not noteref-1 etc), to check the regex above hasn't missed any
+NOTEREF_WORD_REGEX = re.compile(r"(?<![\w-])noteref(?![\w-])")
+
 
 class ListNote:
 	"""
 	Class to hold information on endnotes
 	"""
-	number = 0
-	anchor = ""
-	contents = []  # the strings and tags inside an <li> element
-	back_link = ""
-	source_file = ""
-	matched = False
+	__slots__ = ("number", "anchor", "text", "contents", "back_link", "source_file", "matched")
+
+	def __init__(self):
+		self.number = 0
+		self.anchor = ""
+		self.text = None  # any text inside the <li> element before its first child element
+		self.contents = []  # the elements inside an <li> element, each carrying the text which follows it
+		self.back_link = ""
+		self.source_file = ""
+		self.matched = False
 
 
-def get_content_files(opf: BeautifulSoup) -> list:
+def get_content_files(opf_path: str) -> list:
 	"""
 	Reads the spine from content.opf to obtain a list of content files, in the order wanted for the ToC.
-	:param opf: Beautiful Soup object of the content.opf file
+	:param opf_path: path to the content.opf file
 	:return: list of content files in the wanted order
 	"""
-	itemrefs = opf.find_all("itemref")
 	ret_list = []
-	for itemref in itemrefs:
-		ret_list.append(itemref["idref"])
+	# iterparse still builds the whole tree, but only hands us the itemrefs, so we never walk the rest of it ourselves
+	for _, itemref in etree.iterparse(opf_path, tag=OPF_NS + "itemref"):
+		ret_list.append(itemref.get("idref"))
 	return ret_list
 
 
@@ -40,13 +67,40 @@ def gethtml(file_path: str) -> str:
 	:return: text of xhtml file
 	"""
 	try:
-		fileobject = open(file_path, 'r', encoding='utf-8')
-	except IOError:
-		print('Could not open ' + file_path)
+		return Path(file_path).read_text(encoding='utf-8')
+	except OSError:
+		# queued with the other messages, so it is reported along with the file it belongs to
+		log('Could not open ' + file_path)
 		return ''
-	text = fileobject.read()
-	fileobject.close()
-	return text
+
+
+def parse_xhtml(xhtml: str) -> etree._Element:
+	"""
+	parses the text of an xhtml (or other xml) file into an lxml tree
+	:param xhtml: text of the file, as returned by gethtml
+	:return: root element of the tree
+	"""
+	# lxml won't accept a unicode string carrying an encoding declaration, so hand it bytes
+	return etree.fromstring(xhtml.encode("utf-8"))
+
+
+def render_xhtml(root: etree._Element) -> str:
+	"""
+	runs a tree through the SE formatter, to get the text to write back to its file
+	:param root: root element of the tree to write
+	:return: the formatted text of the file
+	"""
+	return format_xhtml(etree.tostring(root, encoding="unicode"))
+
+
+def set_text(element: etree._Element, text: Optional[str]):
+	"""
+	replaces everything inside an element with the given text, leaving its attributes alone
+	:param element: the element to change
+	:param text: the new text, or None to empty the element
+	"""
+	del element[:]
+	element.text = text
 
 
 def extract_anchor(href: str) -> str:
@@ -55,185 +109,328 @@ def extract_anchor(href: str) -> str:
 	:param href: should be like: "../text/endnotes.xhtml#note-1"
 	:return: just the part after the hash, eg "note-1"
 	"""
-	hash_position = href.find("#") + 1  # we want the characters AFTER the hash
-	if hash_position > 0:
-		return href[hash_position:]
-	else:
+	# we want the characters AFTER the hash, and nothing if there isn't one
+	_, hash_mark, anchor = href.partition("#")
+	return anchor if hash_mark else ""
+
+
+# messages about individual notes, held back so each file's report is written in one go
+log_messages: List[str] = []
+
+
+def log(message: str):
+	"""
+	queues a message to be written out by the next flush_log
+	:param message: the line to write
+	"""
+	log_messages.append(message)
+
+
+def take_log() -> str:
+	"""
+	empties the queue of messages
+	:return: the queued messages as a block of text, ready to be written out
+	"""
+	if not log_messages:
 		return ""
+	text = "\n".join(log_messages) + "\n"
+	log_messages.clear()
+	return text
 
 
-# global variable, unfortunately
-notes_changed = 0
+def flush_log():
+	"""
+	writes out all queued messages at once
+	"""
+	sys.stdout.write(take_log())
+
 
-def process_file(text_path: str, file_name: str, endnotes: list, de_orphan: bool, current_note_number: int) -> int:
+class FileResult:
+	"""
+	Class to hold what we found while processing a file, so it can be handed back from a worker process
+	"""
+	__slots__ = ("next_note_number", "changed", "matches", "messages", "new_xhtml")
+
+	def __init__(self, current_note_number: int):
+		self.next_note_number = current_note_number
+		self.changed = 0
+		self.matches = []  # (original anchor, new number) for each noteref which matched a single endnote
+		self.messages = ""
+		self.new_xhtml = None  # text to write back to the file, if it needs rewriting
+
+
+def count_noterefs(file_path: str) -> int:
+	"""
+	counts the noterefs in a file without parsing it, so we can tell where its note numbering will start
+	:param file_path: path to the xhtml file
+	:return: number of noterefs in the text, or 0 if the file can't be read
+	"""
+	try:
+		xhtml = Path(file_path).read_text(encoding='utf-8')
+	except OSError:
+		# process_file will report the problem when it gets to this file
+		return 0
+	return len(NOTEREF_REGEX.findall(xhtml))
+
+
+def get_noteref_anchors(xhtml: str) -> Optional[List[str]]:
+	"""
+	finds the anchors the noterefs in a file point to, without parsing it
+	:param xhtml: text of the xhtml file
+	:return: list of anchors in document order, with "" for any noteref without one,
+	or None if the text might hold noterefs the regex can't be trusted to find
+	"""
+	tags = NOTEREF_REGEX.findall(xhtml)
+	# a noteref written in a way the regex doesn't expect, or one inside a comment or CDATA section,
+	# would leave our list out of step with what parsing finds, so don't guess
+	if len(NOTEREF_WORD_REGEX.findall(xhtml)) != len(tags) or "<!--" in xhtml or "<![CDATA[" in xhtml:
+		return None
+	anchors = []
+	for tag in tags:
+		href = HREF_REGEX.search(tag)
+		anchors.append(extract_anchor(href.group(1)) if href else "")
+	return anchors
+
+
+def iter_noterefs(elements: Iterable[etree._Element]) -> Iterator[etree._Element]:
 	"""
-	Reads a content file, locates and processes the endnotes,
-	accumulating info on them in a global list, and returns the next note number
+	yields every noteref link within the given elements, in document order
+	:param elements: the elements to search, eg the root of a content file or the contents of an endnote
+	:return: generator of <a> elements
+	"""
+	for element in elements:
+		yield from NOTEREF_XPATH(element)
+
+
+def renumber_noteref(link: etree._Element, location: str, anchor_counts: dict, de_orphan: bool, result: FileResult) -> bool:
+	"""
+	Gives a single noteref the next note number, recording the change and any matching endnote in result
+	:param link: the noteref <a> element
+	:param location: how to describe where the link is when reporting changes
+	:param anchor_counts: dictionary of the number of endnotes with each original anchor
+	:param de_orphan: remove reference in text if no matching endnote
+	:param result: what we have found so far in this file
+	:return: True if the link was changed, so the file needs writing back
+	"""
+	current_note_number = result.next_note_number
+	needs_rewrite = False
+	old_anchor = ""
+	href = link.get("href") or ""
+	if href:
+		old_anchor = extract_anchor(href)
+	number = str(current_note_number)
+	new_anchor = f"note-{number}"
+	if new_anchor != old_anchor:
+		log("Changed " + old_anchor + " to " + new_anchor + " in " + location)
+		result.changed += 1
+		# update the link in the tree
+		link.set("href", f"endnotes.xhtml#{new_anchor}")
+		link.set("id", f"noteref-{number}")
+		set_text(link, number)
+		needs_rewrite = True
+	# now try to find this in endnotes
+	if find_endnote(old_anchor, anchor_counts, result) == 0 and de_orphan:
+		log("Removing orphan note ref in text")
+		set_text(link, None)
+		needs_rewrite = True
+	result.next_note_number += 1
+	return needs_rewrite
+
+
+def find_endnote(old_anchor: str, anchor_counts: dict, result: FileResult) -> int:
+	"""
+	Looks for the endnote a noteref points to, reporting it if missing or duplicated,
+	and records it in result against the next note number if there is exactly one
+	:param old_anchor: the anchor the noteref pointed to before renumbering
+	:param anchor_counts: dictionary of the number of endnotes with each original anchor
+	:param result: what we have found so far in this file
+	:return: the number of endnotes with that anchor
+	"""
+	match_count = anchor_counts.get(old_anchor, 0)
+	if match_count == 0:
+		log("Couldn't find endnote with anchor " + old_anchor)
+	elif match_count > 1:
+		log("Duplicate anchors in endnotes file for anchor " + old_anchor)
+	else:  # found a single match, which is what we want
+		result.matches.append((old_anchor, result.next_note_number))
+	return match_count
+
+
+def apply_matches(anchor_index: dict, matches: list, file_name: str):
+	"""
+	updates the endnotes matched while processing a file
+	:param anchor_index: dictionary of lists of notes, keyed by their original anchor
+	:param matches: list of (original anchor, new number) pairs
+	:param file_name: the name of the file the noterefs are in, to be used for the endnotes' back links
+	"""
+	for old_anchor, number in matches:
+		listnote = anchor_index[old_anchor][0]
+		listnote.number = number
+		listnote.matched = True
+		# we don't change the back ref just yet
+		listnote.source_file = file_name
+		if file_name == "endnotes.xhtml":
+			# as before, a note found from within another note takes its new anchor straight away;
+			# anchor_index stays keyed on the original anchors, so lookups are unaffected
+			listnote.anchor = f"note-{number}"
+
+
+def process_file(text_path: str, file_name: str, anchor_counts: dict, de_orphan: bool, current_note_number: int) -> FileResult:
+	"""
+	Reads a content file, locates and processes the endnotes, and returns what it found, including the new text
+	of the file if it needs rewriting, so the caller can check it, write it and update the list of endnotes.
+	This runs in a worker process, so it must not rely on any state from the main process, and must not write anything.
 	:param text_path: path to the text files in the project
 	:param file_name: the name of the file being processed eg chapter-1.xhtml
-	:param endnotes: list of notes we are building
+	:param anchor_counts: dictionary of the number of endnotes with each original anchor
 	:param de_orphan: remove reference in text if no matching endnote
-	:param current_note_number: the current note number we are allocating
-	:return: the next note number to use
+	:param current_note_number: the note number to give the first noteref in this file
+	:return: the changes and matches made, and the next note number to use
 	"""
-	global notes_changed
+	result = FileResult(current_note_number)
 	file_path = os.path.join(text_path, file_name)
 	xhtml = gethtml(file_path)
-	soup = BeautifulSoup(xhtml, "lxml")
-	links = soup.find_all("a")
+	if not xhtml:
+		result.messages = take_log()
+		return result
+
+	# when rerunning on a book, most files will already be numbered correctly, and if so
+	# we only need to note which endnotes they point to, without parsing or rewriting anything
+	old_anchors = get_noteref_anchors(xhtml)
+	if old_anchors is not None and all(anchor == f"note-{number}" for number, anchor in enumerate(old_anchors, current_note_number)):
+		if not de_orphan or all(anchor in anchor_counts for anchor in old_anchors):
+			for old_anchor in old_anchors:
+				find_endnote(old_anchor, anchor_counts, result)
+				result.next_note_number += 1
+			result.messages = take_log()
+			return result
+
+	root = parse_xhtml(xhtml)
 	needs_rewrite = False
-	for link in links:
-		epub_type = link.get("epub:type") or ""
-		if epub_type == "noteref":
-			old_anchor = ""
-			href = link.get("href") or ""
-			if href:
-				old_anchor = extract_anchor(href)
-			new_anchor = "note-{:d}".format(current_note_number)
-			if new_anchor != old_anchor:
-				print("Changed " + old_anchor + " to " + new_anchor + " in " + file_path)
-				notes_changed += 1
-				# update the link in the soup object
-				link["href"] = 'endnotes.xhtml#' + new_anchor
-				link["id"] = 'noteref-{:d}'.format(current_note_number)
-				link.string = str(current_note_number)
-				needs_rewrite = True
-			# now try to find this in endnotes
-			matches = list(filter(lambda x: x.anchor == old_anchor, endnotes))
-			if len(matches) == 0:
-				print("Couldn't find endnote with anchor " + old_anchor)
-				if de_orphan:
-					print("Removing orphan note ref in text")
-					link.clear()
-					needs_rewrite = True
-			elif len(matches) > 1:
-				print("Duplicate anchors in endnotes file for anchor " + old_anchor)
-			else:  # found a single match, which is what we want
-				listnote = matches[0]
-				listnote.number = current_note_number
-				listnote.matched = True
-				# we don't change the anchor or the back ref just yet
-				listnote.source_file = file_name
-			current_note_number += 1
+	for link in iter_noterefs([root]):
+		if renumber_noteref(link, file_path, anchor_counts, de_orphan, result):
+			needs_rewrite = True
 
+	result.messages = take_log()
 	# if we need to write back the body text file
 	if needs_rewrite:
-		new_file = open(file_path, "w")
-		new_file.write(format_xhtml(str(soup)))
-		# new_file.write(str(soup))
-		new_file.close()
-	return current_note_number
+		# etree.tostring drops the xml declaration, so only the formatted text can be compared with what we read;
+		# this saves the write, not the formatting (eg when an orphan note ref that was already empty is emptied again)
+		new_xhtml = render_xhtml(root)
+		if new_xhtml != xhtml:
+			result.new_xhtml = new_xhtml
+	return result
+
+
+# set once in each worker process by init_worker, so they aren't pickled again for every file
+worker_anchor_counts: Dict[str, int] = {}
+worker_de_orphan = False
+
+
+def init_worker(anchor_counts: dict, de_orphan: bool):
+	"""
+	stores the settings shared by every file a worker process handles
+	:param anchor_counts: dictionary of the number of endnotes with each original anchor
+	:param de_orphan: remove reference in text if no matching endnote
+	"""
+	global worker_anchor_counts, worker_de_orphan
+	worker_anchor_counts = anchor_counts
+	worker_de_orphan = de_orphan
 
 
-def process_endnotes_file(endnotes: list, de_orphan: bool, current_note_number: int) -> int:
+def process_file_in_worker(text_path: str, file_name: str, current_note_number: int) -> FileResult:
+	"""
+	runs process_file in a worker process, using the settings given to init_worker
+	:param text_path: path to the text files in the project
+	:param file_name: the name of the file being processed eg chapter-1.xhtml
+	:param current_note_number: the note number to give the first noteref in this file
+	:return: the changes and matches made, and the next note number to use
+	"""
+	return process_file(text_path, file_name, worker_anchor_counts, worker_de_orphan, current_note_number)
+
+
+def process_endnotes_file(endnotes: list, anchor_index: dict, de_orphan: bool, current_note_number: int) -> Tuple[int, int]:
 	"""
 	Reads the endnotes in memory, looking for note links WITHIN the body of notes
 	:param endnotes: list of notes we are building
+	:param anchor_index: dictionary of lists of notes, keyed by their original anchor
 	:param de_orphan: remove reference in text if no matching endnote
 	:param current_note_number: the current note number we are allocating
-	:return: the next note number to use
+	:return: the next note number to use, and the number of noterefs changed
 	"""
-	global notes_changed
+	anchor_counts = {anchor: len(notes) for anchor, notes in anchor_index.items()}
+	result = FileResult(current_note_number)
 	for endnote in endnotes:
-		for content in endnote.contents:
-			if isinstance(content, Tag):
-				links = content.find_all("a")
-				for link in links:
-					epub_type = link.get("epub:type") or ""
-					if epub_type == "noteref":
-						old_anchor = ""
-						href = link.get("href") or ""
-						if href:
-							old_anchor = extract_anchor(href)
-						new_anchor = "note-{:d}".format(current_note_number)
-						if new_anchor != old_anchor:
-							print("Changed " + old_anchor + " to " + new_anchor + " in endnotes.xhtml")
-							notes_changed += 1
-							# update the link in the soup object
-							link["href"] = 'endnotes.xhtml#' + new_anchor
-							link["id"] = 'noteref-{:d}'.format(current_note_number)
-							link.string = str(current_note_number)
-							needs_rewrite = True
-							# now try to find this in existing endnotes
-							matches = list(filter(lambda x: x.anchor == old_anchor, endnotes))
-							if len(matches) == 0:
-								print("Couldn't find endnote with anchor " + old_anchor)
-								if de_orphan:
-									print("Removing orphan note ref in text")
-									link.clear()
-									needs_rewrite = True
-							elif len(matches) > 1:
-								print("Duplicate anchors in endnotes file for anchor " + old_anchor)
-							else:  # found a single match, which is what we want
-								listnote = matches[0]
-								listnote.number = current_note_number
-								listnote.matched = True
-								# we don't change the anchor or the back ref just yet
-								listnote.source_file = "endnotes.xhtml"
-								listnote.anchor = new_anchor
-							current_note_number += 1
-	return current_note_number
-
-
-def get_notes(endnotes_soup: BeautifulSoup) -> list:
-	"""
-	gets the list of notes in the current endnotes.xhtml file
-	:param endnotes_soup: the endnotes.xhtml file as a BS object
-	:return: list of note objects
+		for link in iter_noterefs(endnote.contents):
+			# endnotes.xhtml is rewritten by recreate, so we don't need to track the need to rewrite here
+			renumber_noteref(link, "endnotes.xhtml", anchor_counts, de_orphan, result)
+	apply_matches(anchor_index, result.matches, "endnotes.xhtml")
+	flush_log()
+	return result.next_note_number, result.changed
+
+
+def get_notes(notes_path: str) -> Tuple[etree._Element, List[ListNote], Dict[str, List[ListNote]]]:
+	"""
+	gets the list of notes in the current endnotes.xhtml file, collecting each note as soon as it has been parsed
+	:param notes_path: path to the endnotes.xhtml file
+	:return: root element of the parsed file, list of note objects, and a dictionary of those notes keyed by anchor
 	"""
 	ret_list = []
-	ol: BeautifulSoup = endnotes_soup.find("ol")
-	items = ol.find_all("li")
-	# do something
-	for item in items:
+	anchor_index: Dict[str, List[ListNote]] = {}
+	ol = None
+	context = etree.iterparse(notes_path, events=("start", "end"), tag=(XHTML_NS + "ol", XHTML_NS + "li"))
+	for event, item in context:
+		if event == "start":
+			# the first list is the endnotes themselves; any later ones are inside notes
+			if ol is None and item.tag == XHTML_NS + "ol":
+				ol = item
+			continue
+		if item.tag != XHTML_NS + "li" or ol is None or item.getparent() is not ol:
+			continue
 		note = ListNote()
-		note.contents = []
-		for content in item.contents:
+		# iterating over the <li> only gives its child elements, so keep any text before the first one separately
+		note.text = item.text
+		for content in item:
 			note.contents.append(content)
-			if isinstance(content, Tag):
-				links = content.find_all("a")
-				for link in links:
-					epub_type = link.get("epub:type") or ""
-					if epub_type == "se:referrer" or epub_type == "backlink":
-						href = link.get("href") or ""
-						if href:
-							note.back_link = href
+			for link in REFERRER_XPATH(content):
+				href = link.get("href") or ""
+				if href:
+					note.back_link = href
 		note.anchor = item.get("id") or ""
 
 		ret_list.append(note)
-	return ret_list
+		# there should only be one note per anchor, but we keep any duplicates so we can report them
+		anchor_index.setdefault(note.anchor, []).append(note)
+	return context.root, ret_list, anchor_index
 
 
-def recreate(textpath: str, notes_soup: BeautifulSoup, endnotes: list):
+def recreate(textpath: str, notes_root: etree._Element, endnotes: list):
 	"""
 	rebuilds endnotes.xhtml in the correct (possibly new) order
 	:param textpath: path to text folder in SE project
-	:param notes_soup:
-	:param endnotes:
+	:param notes_root: root element of the parsed endnotes.xhtml file
+	:param endnotes: list of notes we have built
 	:return:
 	"""
-	ol = notes_soup.ol
-	ol.clear()
-	endnotes.sort(key=lambda enote: enote.number)
+	ol = notes_root.find(".//" + XHTML_NS + "ol")
+	del ol[:]
+	endnotes.sort(key=attrgetter("number"))
+	# every <li> starts out the same, so copy a prepared one rather than building each from scratch;
+	# the id is there to keep it ahead of epub:type in the output once it is set
+	template = etree.Element(XHTML_NS + "li", {"id": "", EPUB_TYPE: "endnote"})
 	for endnote in endnotes:
 		if endnote.matched:
-			li = notes_soup.new_tag("li")
-			li["id"] = "note-" + str(endnote.number)
-			li["epub:type"] = "endnote"
+			li = copy.copy(template)
+			li.set("id", f"note-{endnote.number}")
+			li.text = endnote.text
+			ol.append(li)
 			for content in endnote.contents:
-				if isinstance(content, Tag):
-					links = content.find_all("a")
-					for link in links:
-						epub_type = link.get("epub:type") or ""
-						if "se:referrer" in epub_type or "backlink" in epub_type:
-							href = link.get("href") or ""
-							if href:
-								link["href"] = endnote.source_file + "#noteref-" + str(endnote.number)
+				for link in REFERRER_XPATH(content):
+					href = link.get("href") or ""
+					if href:
+						link.set("href", endnote.source_file + "#noteref-" + str(endnote.number))
 				li.append(content)
-			ol.append(li)
-	new_file = open(os.path.join(textpath, "endnotes.xhtml"), "w")
-	new_file.write(format_xhtml(str(notes_soup)))
-	new_file.close()
+	Path(textpath, "endnotes.xhtml").write_text(render_xhtml(notes_root), encoding='utf-8')
 
 
 # don't process these files
@@ -241,7 +438,6 @@ exclude_list = ["titlepage.xhtml", "colophon.xhtml", "uncopyright.xhtml", "impri
 
 
 def main():
-	global notes_changed
 	parser = argparse.ArgumentParser(description="Renumber endnotes from beginning")
 	parser.add_argument("-r", "--remove_orphans", action="store_true", help="remove notes in text if note is missing in endnotes.xhtml")
 	parser.add_argument("directory", metavar="DIRECTORY", help="a Standard Ebooks source directory")
@@ -265,25 +461,53 @@ def main():
 	else:
 		de_orphan = False
 
-	xhtml = gethtml(notespath)
-	notes_soup = BeautifulSoup(xhtml, "lxml")
-	endnotes = get_notes(notes_soup)
+	notes_root, endnotes, anchor_index = get_notes(notespath)
 
-	xhtml = gethtml(opfpath)
-	soup = BeautifulSoup(xhtml, "lxml")
-	file_list = get_content_files(soup)
+	anchor_counts = {anchor: len(notes) for anchor, notes in anchor_index.items()}
+	file_list = [file_name for file_name in get_content_files(opfpath) if file_name not in exclude_list]
 
-	processed = 0
+	# count the notes in each file first, so we know where each file's numbering starts
+	# and the files can then be processed independently of each other
+	note_counts = []
+	start_numbers = []
 	current_num = 1
 	for file_name in file_list:
-		if file_name in exclude_list:
-			continue
+		note_count = count_noterefs(os.path.join(textpath, file_name))
+		note_counts.append(note_count)
+		start_numbers.append(current_num)
+		current_num += note_count
+
+	with ProcessPoolExecutor(initializer=init_worker, initargs=(anchor_counts, de_orphan)) as executor:
+		results = list(executor.map(process_file_in_worker, repeat(textpath), file_list, start_numbers))
+
+	# nothing has been written yet, so if the quick count was wrong for any file, the numbering
+	# from that file on is wrong too, and we throw it all away and go through the files in order instead
+	if any(result.next_note_number != start_number + note_count for start_number, note_count, result in zip(start_numbers, note_counts, results)):
+		print("Couldn't count the note refs in every file in advance, so processing the files one at a time")
+		results = []
+		current_num = 1
+		for file_name in file_list:
+			result = process_file(textpath, file_name, anchor_counts, de_orphan, current_num)
+			results.append(result)
+			current_num = result.next_note_number
+
+	processed = 0
+	notes_changed = 0
+	current_num = 1
+	# results are in spine order, so we can report, write and update the endnotes as we go
+	for file_name, result in zip(file_list, results):
 		print("Processing " + file_name)
+		sys.stdout.write(result.messages)
 		processed += 1
-		current_num = process_file(textpath, file_name, endnotes, de_orphan, current_num)
+		apply_matches(anchor_index, result.matches, file_name)
+		notes_changed += result.changed
+		current_num = result.next_note_number
+		if result.new_xhtml is not None:
+			Path(textpath, file_name).write_text(result.new_xhtml, encoding='utf-8')
 		print("Endnotes processed so far: " + str(current_num - 1))  # we subtract 1 because process_file increments it after each note found
 	# look inside endnotes.xhtml itself for notes to notes
-	process_endnotes_file(endnotes, de_orphan, current_num)
+	_, changed = process_endnotes_file(endnotes, anchor_index, de_orphan, current_num)
+	notes_changed += changed
 	if processed == 0:
 		print("No files processed. Did you update manifest and order the spine?")
 	else:
@@ -291,7 +515,7 @@ def main():
 		if notes_changed > 0:
 			print("Changed {:d} endnotes".format(notes_changed))
 			# so we need to recreate the endnotes file
-			recreate(textpath, notes_soup, endnotes)
+			recreate(textpath, notes_root, endnotes)
 		else:
 			print("No changes made")
 